@@ -2,11 +2,32 @@
 This module contains the cachefunction() decorator and the CacheFunction() decorator class. The purpose of these cache objects is to support generic function caching with a save-to-disk feature.
 """
 
+import os
+import sys
 import pickle as pkl
 from pathlib import Path
 import atexit
-from functools import wraps
-from typing import Callable, Any, Union
+import weakref
+import struct
+import mmap
+import inspect
+import warnings
+from io import BytesIO
+from functools import lru_cache, partial, update_wrapper
+from collections import OrderedDict, namedtuple
+from typing import Callable, Any, Union, Optional
+
+# optional dependencies
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# optional compiled helpers, see cachefunctions/_fastkey.pyx
+try:
+    from ._fastkey import makekey as _fastmakekey
+except ImportError:
+    _fastmakekey = None
 
 # globals
 # type hints
@@ -22,7 +43,8 @@ def dict2tuple(di:dict) -> tuple :
     :param di: the dictionary to convert from {k1:v1,k2:v2} to [(k1, v1), (k2,v2)]
     :return: a tuple of the form ((k1, v1), (k2,v2))
     """
-    return tuple([(key, value) for key,value in sorted(di.items(), key=lambda x: x[0])])
+    # items are (key, value) tuples with unique keys, so the default tuple ordering already sorts by key
+    return tuple(sorted(di.items()))
 
 def cachefunction(fname:TypeStrPath) -> TypeGenericFunction:
     """
@@ -40,7 +62,190 @@ def cachefunction(fname:TypeStrPath) -> TypeGenericFunction:
         return fc.decorator(fun)
     return wrap
 
+def _saveall() -> None:
+    """
+    atexit hook, saves every FunctionCache that is still alive and whose log has reached its compactsize.
+    Smaller logs are left for the next run to replay, so a run that computed little does not rewrite the whole cache file.
+    atexit runs before interpreter teardown, so the whole standard library is still usable here.
+    """
+    for functioncache in list(FunctionCache._INSTANCES.values()):
+        if not functioncache.savebeforedelete or functioncache._log.tell() < functioncache.compactsize:
+            continue
+        # one cache failing to save must not keep the others from saving
+        try:
+            functioncache.save()
+        except Exception as e:
+            warnings.warn(f"{functioncache.fpath} was not saved: {e!r}", RuntimeWarning)
+
+atexit.register(_saveall)
+
+def _freeze(x:Any) -> Any:
+    """
+    Interns the strings inside a cache key, recursing into tuples.
+    Keys are frozen once when they are stored, so equal strings across many keys share one object and compare by identity on later lookups.
+
+    :param x: a cache key, or an element of one
+    :return: an equal object whose strings are interned
+    """
+    if type(x) is str:
+        return sys.intern(x)
+    if type(x) is tuple:
+        return tuple(map(_freeze, x))
+    if type(x) is _CacheKey:
+        # the frozen key is equal to x.key, so it has the same hash
+        return _CacheKey(_freeze(x.key), x._hash)
+    return x
+
+def _migratekey(key:Any) -> Any:
+    """
+    Converts a key written by the original cache format, (args, ((k1, v1), (k2, v2))), to the current format.
+    Keys of any other shape are returned unchanged.
+
+    :param key: a key read from a cache file that holds a single dictionary
+    :return: args if there were no keyword arguments, otherwise (args, _KWMARK, ((k1, v1), (k2, v2)))
+    """
+    if not (type(key) is tuple and len(key) == 2 and type(key[0]) is tuple and type(key[1]) is tuple):
+        return key
+    args, kwitems = key
+    if not all(type(item) is tuple and len(item) == 2 and type(item[0]) is str for item in kwitems):
+        return key
+    key = (args, _KWMARK, kwitems) if kwitems else args
+    if len(args) + len(kwitems) >= _CACHEKEY_MINARGS:
+        key = _CacheKey(key)
+    return key
+
+def _ishashable(args:tuple, kwargs:dict) -> bool:
+    """ returns True if every positional argument and keyword argument value is hashable """
+    try:
+        hash((args, tuple(kwargs.values())))
+    except TypeError:
+        return False
+    return True
+
+def _functionidentity(fun:TypeGenericFunction) -> tuple:
+    """
+    Returns the objects that decide what a function computes: its code, the object it is bound to, its default values and its closure cells.
+    Two functions with the same identity, compared element by element with `is`, return the same results.
+    Callables without __code__, such as a functools.partial, are only identical to themselves.
+
+    :param fun: the function to identify
+    :return: a tuple to compare with _sameidentity()
+    """
+    code = getattr(fun, '__code__', None)
+    if code is None:
+        return (fun,)
+    defaults = getattr(fun, '__defaults__', None) or ()
+    kwdefaults = tuple((getattr(fun, '__kwdefaults__', None) or {}).values())
+    closure = getattr(fun, '__closure__', None) or ()
+    return (code, getattr(fun, '__self__', None)) + defaults + kwdefaults + closure
+
+def _sameidentity(a:tuple, b:tuple) -> bool:
+    """ returns True if the _functionidentity() tuples a and b hold the same objects """
+    return len(a) == len(b) and all(x is y for x, y in zip(a, b))
+
+def _positionalparameters(fun:TypeGenericFunction) -> tuple:
+    """
+    Names the parameters of fun when they are all required and may be passed by position, so that the decorator can use a wrapper with a fixed signature.
+    Returns an empty tuple for anything else: defaults, *args, **kwargs, keyword-only parameters, or a signature inspect cannot read.
+
+    :param fun: the function being decorated
+    :return: a tuple of parameter names, empty if the signature cannot be specialized
+    """
+    try:
+        parameters = inspect.signature(fun).parameters.values()
+    except (TypeError, ValueError):
+        return ()
+    for parameter in parameters:
+        if parameter.kind is not parameter.POSITIONAL_OR_KEYWORD or parameter.default is not parameter.empty:
+            return ()
+    return tuple(parameter.name for parameter in parameters)
+
+def _msgpackdefault(obj:Any) -> Any:
+    """ msgpack hook, encodes the objects msgpack does not know about that appear in cache keys """
+    if obj is _KWMARK:
+        return msgpack.ExtType(_MSGPACK_KWMARK, b"")
+    if type(obj) is _CacheKey:
+        return msgpack.ExtType(_MSGPACK_CACHEKEY, msgpack.packb(obj.key, default=_msgpackdefault))
+    raise TypeError(f"{type(obj)!r} is not msgpack serializable")
+
+def _msgpackexthook(code:int, data:bytes) -> Any:
+    """ msgpack hook, inverse of _msgpackdefault """
+    if code == _MSGPACK_KWMARK:
+        return _KWMARK
+    if code == _MSGPACK_CACHEKEY:
+        return _CacheKey(msgpack.unpackb(data, use_list=False, strict_map_key=False, ext_hook=_msgpackexthook))
+    return msgpack.ExtType(code, data)
+
 # classes
+class _KwargsMark:
+    """
+    Separates positional arguments from keyword arguments inside a cache key, so f((1,), (('a',2),)) and f(1, a=2) never share a key.
+    Pickles by reference, so keys reloaded from disk contain the same singleton object.
+    """
+    __slots__ = ()
+
+    def __reduce__(self) -> str:
+        return "_KWMARK"
+
+class _CacheKey:
+    """
+    Wraps a cache key built from many arguments and computes its hash once.
+    A miss hashes the key several times (dictionary lookup, dictionary insert), which adds up for long argument lists.
+    The hash is recomputed on unpickling, since str hashes change between python processes.
+    """
+    __slots__ = ('key', '_hash')
+
+    def __init__(self, key:tuple, keyhash:Optional[int]=None):
+        """
+        :param key: the cache key to wrap
+        :param keyhash: hash(key), if the caller already knows it
+        """
+        self.key = key
+        self._hash = hash(key) if keyhash is None else keyhash
+
+    def __hash__(self) -> int:
+        return self._hash
+
+    def __eq__(self, other:Any) -> bool:
+        return type(other) is _CacheKey and self._hash == other._hash and self.key == other.key
+
+    def __reduce__(self) -> tuple:
+        return (_CacheKey, (self.key,))
+
+    def __repr__(self) -> str:
+        return f"_CacheKey({self.key!r})"
+
+# keys built from at least this many arguments are wrapped in a _CacheKey
+_CACHEKEY_MINARGS = 8
+
+# sentinel placed between args and kwargs in cache keys
+_KWMARK = _KwargsMark()
+# sentinel returned by dict.get when a key is not cached
+_MISS = object()
+
+# returned by cache_info() on functions decorated by a bounded FunctionCache, same fields as functools.lru_cache
+_CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+# each log record is an 8 byte little-endian length followed by the serialized (key, value) pair
+_LOGHEADER = struct.Struct("<Q")
+
+# cache files start with _MAGIC, followed by one serialized record per value, the serialized index {key: (offset, length)}, and the index offset packed as an 8 byte little-endian integer
+_MAGIC = b"CFCACHE1"
+_FOOTER = struct.Struct("<Q")
+
+# serializers available to FunctionCache, name: (dump(obj, file), load(file))
+_MSGPACK_KWMARK = 1
+_MSGPACK_CACHEKEY = 2
+_SERIALIZERS = {
+    "pickle": (partial(pkl.dump, protocol=pkl.HIGHEST_PROTOCOL), pkl.load),
+}
+if msgpack is not None:
+    # msgpack arrays come back as tuples so that keys stay hashable
+    _SERIALIZERS["msgpack"] = (
+        partial(msgpack.pack, default=_msgpackdefault),
+        partial(msgpack.unpack, use_list=False, strict_map_key=False, ext_hook=_msgpackexthook),
+    )
+
 class FunctionCache:
     """
     Provides a decorator for your cacheable function.
@@ -68,52 +273,182 @@ class FunctionCache:
     # to decorate an imported function
     from slowfunction import slowfunction
     slowfunction = myfunccache.decorator(slowfunction)
+
+    There is one FunctionCache per cache file: constructing a FunctionCache for a file that already has one returns the existing object, so a single cache is saved at exit.
+    Cache keys are built from the arguments alone, so a cache file holds the results of one function. Decorating a second, different function through the same FunctionCache raises a ValueError.
     """
-    # prevent the `open` builtin from being garbage collected before this class
-    open = open
+    # the live FunctionCache of each resolved cache file path, _saveall() saves them at exit
+    _INSTANCES = weakref.WeakValueDictionary()
+
+    # file buffer size used to read and write the cache, large buffers turn a big save into a few large writes
+    buffersize = 4*1024*1024
 
-    def __init__(self, fpath:TypeStrPath):
+    # log size in bytes from which the interpreter exit folds the log into the cache file, smaller logs are replayed on the next load
+    compactsize = 4*1024*1024
+
+    # the open log and the mapped cache file, None until __init__ sets them up so that __del__ also works on a FunctionCache whose __init__ failed
+    _log = None
+    _mmap = None
+
+    def __new__(cls, fpath:TypeStrPath, serializer:str="pickle", maxsize:Optional[int]=None):
+        """ returns the existing FunctionCache of fpath if there is one, otherwise a new FunctionCache """
+        functioncache = cls._INSTANCES.get(Path(fpath).resolve())
+        if functioncache is None:
+            functioncache = super().__new__(cls)
+        return functioncache
+
+    def __init__(self, fpath:TypeStrPath, serializer:str="pickle", maxsize:Optional[int]=None):
         """
         Initialize a FunctionCache object.
+        If fpath already has a FunctionCache, __new__ returned it and it is left as it is.
 
-        :param fpath: A Path or pathlike string to a cache object pickle
+        :param fpath: A Path or pathlike string to the cache file. The file is a CFCACHE1 container, see _MAGIC, that earlier versions and plain pickle.load cannot read. Files written by earlier versions, a single pickled dictionary, are loaded and rewritten as a container on the next save.
+        :param serializer: file format of the cache, "pickle" (default) or "msgpack". msgpack requires the msgpack package, and only supports msgpack-native arguments and results. Lists are returned as tuples.
+        :param maxsize: maximum number of cached results, the least recently used result is evicted first. None (default) lets the cache grow without bound.
         """
-        self.fpath = Path(fpath)
+        resolved = Path(fpath).resolve()
+        if self._INSTANCES.get(resolved) is self:
+            if (serializer, maxsize) != (self.serializer, self.maxsize):
+                raise ValueError(f"{fpath} already has a FunctionCache with serializer={self.serializer!r} and maxsize={self.maxsize!r}")
+            return
+        # the resolved path, like the key in _INSTANCES, so that the file and its log stay put if the working directory changes
+        self.fpath = resolved
+        if maxsize is not None and maxsize < 1:
+            raise ValueError(f"maxsize must be a positive integer or None, got {maxsize!r}")
+        self.maxsize = maxsize
+        # pick the file format
+        if serializer == "msgpack" and msgpack is None:
+            raise ImportError("the msgpack serializer requires the msgpack package")
+        if serializer not in _SERIALIZERS:
+            raise ValueError(f"unknown serializer {serializer!r}, expected one of {sorted(_SERIALIZERS)}")
+        self.serializer = serializer
+        self._dump, self._load = _SERIALIZERS[serializer]
+        # new entries are appended to the log as they are computed, and folded into fpath by save()
+        self.logpath = self.fpath.with_name(self.fpath.name + ".log")
         # handle the file access
         self._setupfile()
+        self._log = open(self.logpath, 'ab')
+        # set once a result could not be written to the log, so the warning is only issued once
+        self._logfailed = False
+
+        # module and qualified name of the function this cache belongs to, and its _functionidentity(), set by the first call to self.decorator
+        self._function = None
+        self._functionidentity = None
 
         # various settings
+        # savebeforedelete: persist new results, by logging them as they are computed and calling save() when the interpreter exits with a log of at least compactsize bytes
+        # set it to False to keep new results in memory only
         self.savebeforedelete=True
+        self._INSTANCES[resolved] = self
 
     def _setupfile(self) -> None:
         """
         Verifies that self.fpath is valid. 
         If self.fpath does not exist, a new cache is created that will be saved to that location.
-        If self.fpath does exist and is a file, it will be treated as a cache and loaded.
+        If self.fpath does exist and is a file, it will be treated as a cache and its index is loaded. Values are only read from the file when first requested.
         If self.fpath does exist and is not a file, an error will be thrown.
+        Entries in self.logpath that were never saved into self.fpath are replayed on top of the loaded cache.
         """
+        # self._cache holds results in memory, self._index locates results in self.fpath that have not been read yet
+        self._cache = dict()
+        self._index = dict()
+        self._mmap = None
         # if fname exists:
         if self.fpath.exists():
             # if fname is a file:
             if self.fpath.is_file():
-                # load the file to self._cache
-                with open(self.fpath, 'rb') as f:
-                    self._cache = pkl.load(f)
+                if self._mapfile():
+                    # load the index of the file to self._index
+                    (indexoffset,) = _FOOTER.unpack(self._mmap[-_FOOTER.size:])
+                    index = self._load(BytesIO(self._mmap[indexoffset:-_FOOTER.size]))
+                    self._index.update((_freeze(key), location) for key, location in index.items())
+                else:
+                    # cache files written by earlier versions hold a single dictionary with keys of the form (args, kwargs), load it to self._cache
+                    with open(self.fpath, 'rb', buffering=self.buffersize) as f:
+                        self._cache.update((_freeze(_migratekey(key)), value) for key, value in self._load(f).items())
             # if fname is not a file, throw an error
             else:
                 raise Exception(f"{self.fpath} exists and is not a file")
-        # if fname does not exist, start a new cache dictionary
-        else:
-            self._cache = dict()
+        # a bounded cache keeps its entries in least to most recently used order
+        if self.maxsize is not None:
+            self._cache = OrderedDict(self._cache)
+            while len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+            for key in list(self._index)[:-self.maxsize]:
+                del self._index[key]
+        self._replaylog()
+
+    def _mapfile(self) -> bool:
+        """
+        Maps self.fpath into memory as self._mmap, so values can be read without reading the whole file.
+        :return: False if self.fpath does not start with _MAGIC, in which case nothing is mapped
+        """
+        with open(self.fpath, 'rb') as f:
+            if f.read(len(_MAGIC)) != _MAGIC:
+                return False
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return True
+
+    def _unmapfile(self) -> None:
+        """ closes self._mmap, if there is one """
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _readvalue(self, location:tuple) -> Any:
+        """
+        Reads one value from the memory mapped cache file.
+        :param location: (offset, length) of the serialized value, as stored in self._index
+        """
+        offset, length = location
+        return self._load(BytesIO(self._mmap[offset:offset+length]))
+
+    def _replaylog(self) -> None:
+        """
+        Loads the (key, value) records of self.logpath into self._cache.
+        A truncated record at the end of the log, left behind by a crash, is ignored.
+        """
+        if not self.logpath.is_file():
+            return
+        with open(self.logpath, 'rb', buffering=self.buffersize) as f:
+            while True:
+                header = f.read(_LOGHEADER.size)
+                if len(header) < _LOGHEADER.size:
+                    break
+                (size,) = _LOGHEADER.unpack(header)
+                record = f.read(size)
+                if len(record) < size:
+                    break
+                key, value = self._load(BytesIO(record))
+                key = _freeze(key)
+                self._cache[key] = value
+                self._index.pop(key, None)
+                # a bounded cache is trimmed as it replays, so loading never holds more than maxsize results
+                if self.maxsize is not None:
+                    self._cache.move_to_end(key)
+                    if len(self._cache) > self.maxsize:
+                        self._cache.popitem(last=False)
 
-    def _makekey(self, *args:Any, **kwargs:Any) -> tuple:
+    def _appendlog(self, key:Any, value:Any) -> None:
         """
-        makes a valid key from a functions arguments, assuming all arguments are hashable.
-        :param *args: a tuple of arguments
-        :param **kwargs: a dictionary of keywords
-        :return: given (a1, a2, k1=v1, k2=v2), returns ((a1, a2), ((k1,v1),(k2,v2)))
+        appends a new cache entry to self.logpath, unless self.savebeforedelete is False
+        Each record is flushed to the operating system right away, so it survives the process being killed.
+        An entry that cannot be serialized is not logged, with a RuntimeWarning the first time this happens.
         """
-        return (args, dict2tuple(kwargs))
+        if not self.savebeforedelete:
+            return
+        buffer = BytesIO()
+        try:
+            self._dump((key, value), buffer)
+        except Exception as e:
+            # the result is still returned and kept in memory, it only fails again when the cache is saved
+            if not self._logfailed:
+                self._logfailed = True
+                warnings.warn(f"{self.logpath} skips results that cannot be serialized with {self.serializer}: {e!r}", RuntimeWarning, stacklevel=4)
+            return
+        record = buffer.getvalue()
+        self._log.write(_LOGHEADER.pack(len(record)) + record)
+        self._log.flush()
 
     def decorator(self, fun:TypeGenericFunction) -> TypeGenericFunction:
         """
@@ -131,39 +466,200 @@ class FunctionCache:
         myfunction = fc.decorator(myfunction)
         ```
 
+        The decorated function holds onto the dictionary in self._cache at decoration time, so replacing self._cache afterwards is not supported.
+        A FunctionCache caches one function, it can decorate that function more than once but raises a ValueError for any other function.
+
         :param fun: The function you intend to decorate
         """
-        @wraps(fun) #used to preserve wrapped function properties like __doc__
-        def inner_function(*args, **kwargs):
+        # keys do not name the function, so two functions sharing self._cache would return each other's results
+        # names are not enough, lambdas and closures from one factory share a qualified name
+        function = f"{getattr(fun, '__module__', None)}.{getattr(fun, '__qualname__', repr(fun))}"
+        identity = _functionidentity(fun)
+        if self._function is None:
+            self._function = function
+            self._functionidentity = identity
+        elif not _sameidentity(self._functionidentity, identity):
+            raise ValueError(f"{self.fpath} already caches {self._function}, use a separate cache file for {function}")
+
+        # bind the cache methods as closure locals, saves attribute lookups on every miss
+        cache = self._cache
+        cache_get = cache.get
+        cache_set = cache.__setitem__
+        index_pop = self._index.pop
+        readvalue = self._readvalue
+        appendlog = self._appendlog
+        makekey = _fastmakekey
+        maxsize = self.maxsize
+        if maxsize is not None:
+            cache_touch = cache.move_to_end
+            cache_evict = cache.popitem
+            hits = misses = 0
 
+        def _lookup(*args, **kwargs):
+            """ consults the persisted cache, only called when the in-process lru_cache misses or when the cache is bounded """
+            nonlocal hits, misses
             # convert args and kwargs into a cacheable argument
-            cachekey = self._makekey(*args, **kwargs)
+            # given (a1, a2) the key is (a1, a2), given (a1, a2, k1=v1) the key is ((a1, a2), _KWMARK, ((k1, v1),))
+            if makekey is not None:
+                cachekey = makekey(args, kwargs, _KWMARK)
+            elif kwargs:
+                cachekey = (args, _KWMARK, tuple(sorted(kwargs.items())))
+            else:
+                cachekey = args
+            if len(args) + len(kwargs) >= _CACHEKEY_MINARGS:
+                cachekey = _CacheKey(cachekey)
             
             # attempt to retrieve the cached result
-            try:
-                return self._cache[cachekey]
+            result = cache_get(cachekey, _MISS)
+            if result is not _MISS:
+                if maxsize is not None:
+                    hits += 1
+                    cache_touch(cachekey)
+                return result
             
-            # if the inputs aren't cached, run the function and cache the result
-            except KeyError:
-                result = fun(*args, **kwargs)
-                self._cache[cachekey] = result
+            # results saved by an earlier run are read from the cache file on first use
+            location = index_pop(cachekey, None)
+            if location is not None:
+                result = readvalue(location)
+                if maxsize is not None:
+                    misses += 1
+                    if len(cache) >= maxsize:
+                        cache_evict(last=False)
+                cache_set(_freeze(cachekey), result)
                 return result
 
-            # Usually hit this if an argument is an uncacheable type
-            except TypeError:
-                print("handle uncacheable keys smarter")
-                breakpoint()
-            
+            # if the inputs aren't cached, run the function and cache the result
+            result = fun(*args, **kwargs)
+            if maxsize is not None:
+                misses += 1
+                if len(cache) >= maxsize:
+                    cache_evict(last=False)
+            cachekey = _freeze(cachekey)
+            cache_set(cachekey, result)
+            appendlog(cachekey, result)
+            return result
+
+        if maxsize is None:
+            # functools.lru_cache serves repeat calls from C, self._cache stays the authoritative copy that gets saved
+            cached_function = lru_cache(maxsize=None)(_lookup)
+            cache_info = cached_function.cache_info
+        else:
+            # a bounded cache is served straight from self._cache, so that the saved entries are the most recently used ones
+            cached_function = _lookup
+            def cache_info():
+                """
+                reports the hits, misses, maxsize and currsize of the cache
+                As with the lru_cache of an unbounded cache, results read from the cache file count as misses.
+                """
+                return _CacheInfo(hits, misses, maxsize, len(cache))
+
+        # argument type signatures that can never be hashed, such calls skip the cache entirely
+        unhashable = set()
+
+        def _uncacheable(args:tuple, kwargs:dict) -> bool:
+            """ called when cached_function raised TypeError, returns True if that was because an argument is unhashable """
+            if _ishashable(args, kwargs):
+                return False
+            warnings.warn(f"{getattr(fun, '__qualname__', repr(fun))} was called with unhashable arguments, its result is not cached", RuntimeWarning, stacklevel=3)
+            # only types that are never hashable are remembered, a tuple may or may not hash depending on its contents
+            shape = tuple(map(type, args)) + tuple(map(type, kwargs.values()))
+            if any(argtype.__hash__ is None for argtype in shape):
+                unhashable.add(shape)
+            return True
+
+        # the common one and two argument signatures get wrappers that skip packing *args and **kwargs
+        # a TypeError raised by fun itself is passed through, an uncacheable argument calls fun without caching
+        parameters = _positionalparameters(fun)
+        if len(parameters) == 1:
+            def inner_function(a):
+                if unhashable and (type(a),) in unhashable:
+                    return fun(a)
+                try:
+                    return cached_function(a)
+                except TypeError:
+                    if not _uncacheable((a,), {}):
+                        raise
+                    return fun(a)
+        elif len(parameters) == 2:
+            def inner_function(a, b):
+                if unhashable and (type(a), type(b)) in unhashable:
+                    return fun(a, b)
+                try:
+                    return cached_function(a, b)
+                except TypeError:
+                    if not _uncacheable((a, b), {}):
+                        raise
+                    return fun(a, b)
+        else:
+            def inner_function(*args, **kwargs):
+                if unhashable and tuple(map(type, args)) + tuple(map(type, kwargs.values())) in unhashable:
+                    return fun(*args, **kwargs)
+                try:
+                    return cached_function(*args, **kwargs)
+                except TypeError:
+                    if not _uncacheable(args, kwargs):
+                        raise
+                    return fun(*args, **kwargs)
+        if len(parameters) in (1, 2):
+            # rename a and b to the parameter names of fun, so fun's arguments can still be passed by keyword
+            inner_function.__code__ = inner_function.__code__.replace(co_varnames=parameters)
+
+        # used to preserve wrapped function properties like __doc__
+        update_wrapper(inner_function, fun)
+        # hit and miss statistics of the in-process cache, as on functions decorated with functools.lru_cache
+        inner_function.cache_info = cache_info
         return inner_function
     
     def save(self) -> None:
-        """ saves the cache to self.fpath """
-        with self.open(self.fpath, 'wb') as f:
-            pkl.dump(self._cache, f)
+        """
+        saves the cache to self.fpath, then empties the log since every logged entry is now in self.fpath
+        The cache is written to a temporary file that replaces self.fpath once it is on disk, so a crash mid-save leaves the previous cache intact.
+        """
+        # results that were never read from the current file are copied over as they are, without deserializing them
+        ondisk = list(self._index.items())
+        if self.maxsize is not None:
+            # they are older than anything in memory, so drop them first when the file would exceed maxsize
+            ondisk = ondisk[max(0, len(ondisk) - (self.maxsize - len(self._cache))):]
+        index = dict()
+        tmppath = self.fpath.with_name(self.fpath.name + ".tmp")
+        try:
+            with open(tmppath, 'wb', buffering=self.buffersize) as f:
+                f.write(_MAGIC)
+                for key, (offset, length) in ondisk:
+                    index[key] = (f.tell(), length)
+                    f.write(self._mmap[offset:offset+length])
+                for key, value in self._cache.items():
+                    offset = f.tell()
+                    self._dump(value, f)
+                    index[key] = (offset, f.tell() - offset)
+                indexoffset = f.tell()
+                self._dump(index, f)
+                f.write(_FOOTER.pack(indexoffset))
+                f.flush()
+                os.fsync(f.fileno())
+            # the old file is unmapped first, some platforms cannot replace a mapped file
+            self._unmapfile()
+            try:
+                os.replace(tmppath, self.fpath)
+            finally:
+                self._mapfile()
+        except BaseException:
+            tmppath.unlink(missing_ok=True)
+            raise
+        # point the unread results at their location in the new file
+        self._index.clear()
+        self._index.update((key, index[key]) for key, _ in ondisk)
+        if not self._log.closed:
+            self._log.seek(0)
+            self._log.truncate()
 
     def __del__(self) -> None:
-        """ calls self.save() before deleting class object """
-        if self.savebeforedelete:
-            self.save()
+        """
+        Closes the log before deleting class object, which flushes new entries to disk.
+        The cache itself is saved by an atexit hook, or replayed from the log if this object is deleted first.
+        """
+        if self._log is not None:
+            self._log.close()
+        self._unmapfile()
 
 
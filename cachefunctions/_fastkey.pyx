@@ -0,0 +1,20 @@
+# cython: language_level=3
+"""
+Compiled cache key construction for cachefunctions.
+Build it in place with `cythonize -i cachefunctions/_fastkey.pyx`; without it, cachefunctions builds keys in python.
+"""
+
+cpdef tuple makekey(tuple args, dict kwargs, object kwmark):
+    """
+    Builds the cache key of a call, the same key as the python code in FunctionCache.decorator.
+
+    :param args: the positional arguments of the call
+    :param kwargs: the keyword arguments of the call
+    :param kwmark: the cachefunctions._KWMARK sentinel
+    :return: args if there are no keyword arguments, otherwise (args, kwmark, ((k1, v1), (k2, v2))) sorted by keyword
+    """
+    if not kwargs:
+        return args
+    cdef list items = list(kwargs.items())
+    items.sort()
+    return (args, kwmark, tuple(items))
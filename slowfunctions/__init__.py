@@ -9,13 +9,15 @@ slowfunctionsettings = {
     "sleeptime":1,
     "verbose":False}
 
+# slowfunction counts its calls here, so tests can check whether a cache called it
+slowfunctionstats = {
+    "calls":0}
+
 def slowfunction(*args, **kwargs):
-    """slow function behavior is controlled through module level dictionary slowfunction.slowfunctionsettings"""
-    argtuple = ( \
-        tuple(args), \
-        tuple([(key,value) for key,value \
-            in sorted(kwargs.items(), key=lambda x : x[0])])
-        )
+    """slow function behavior is controlled through module level dictionary slowfunction.slowfunctionsettings, calls are counted in slowfunction.slowfunctionstats"""
+    slowfunctionstats["calls"] += 1
+    # a frozenset hashes the keyword arguments independent of their order, without sorting them
+    argtuple = (tuple(args), frozenset(kwargs.items()))
     hashvalue = hash(argtuple)
 
     if slowfunctionsettings['verbose']:
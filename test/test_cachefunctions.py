@@ -1,12 +1,19 @@
 #!/usr/bin/env python3
 from cachefunctions import FunctionCache, cachefunction 
+import cachefunctions
+import os
 from os import unlink
 from os.path import exists
+import subprocess
+import threading
+import sys
 import unittest
-from time import perf_counter as pc
+from itertools import repeat, starmap
+from functools import partial
 
 # set pickle location globally
 fpath = "data/slowfunctioncache.pkl"
+logpath = fpath + ".log"
 
 # define unittests
 class TestCacheFunction(unittest.TestCase):
@@ -17,12 +24,14 @@ class TestCacheFunction(unittest.TestCase):
         """
 
         # import slowfunctions and config
-        from slowfunctions import slowfunction, slowfunctionsettings
-        slowfunctionsettings['sleeptime'] = 0.25
+        from slowfunctions import slowfunction, slowfunctionsettings, slowfunctionstats
+        slowfunctionsettings['sleeptime'] = 0
+        slowfunctionstats['calls'] = 0
 
         # if the file already exists, delete it
-        if exists(fpath):
-            unlink(fpath)
+        for path in (fpath, logpath):
+            if exists(path):
+                unlink(path)
 
         # init the cache
         slowfunctioncache = FunctionCache(fpath)
@@ -42,12 +51,9 @@ class TestCacheFunction(unittest.TestCase):
                 (3,4),
                 (1,2)]
 
-        # 2 unique arguments should take no more than 0.5s+ds of run time
-        tic = pc()
-        for args in argss:
-            slowfunction(*args)
-        toc = pc()
-        self.assertTrue((toc-tic)<0.6)
+        # 2 unique arguments should only call slowfunction twice
+        list(starmap(slowfunction, argss))
+        self.assertEqual(slowfunctionstats['calls'], 2)
         
         # Test key word arguments
         lasthash = None
@@ -56,17 +62,19 @@ class TestCacheFunction(unittest.TestCase):
             if lasthash is not None:
                 self.assertTrue(lasthash==hashvalue)
             lasthash = hashvalue
+        self.assertEqual(slowfunctionstats['calls'], 3)
 
         # save the cache and delete the object
-        # to recreate nominal exit, we will delete the reference to slowfunction, 
-        # then we will delete the slowfunctioncache object.
-        # When the last reference to slowfunctioncache is gone, the slowfunctioncache.__del__()
-        # method will call slowfunctioncache.save().
+        # at nominal exit an atexit hook calls slowfunctioncache.save(), here we call it ourselves.
+        # Deleting the references to slowfunction and slowfunctioncache drops the cache before the tests exit.
+        slowfunctioncache.save()
+        self.assertTrue(exists(fpath))
         del slowfunction
         del slowfunctioncache
 
         # delete the cache
         unlink(fpath)
+        unlink(logpath)
 
     def test_reload(self):
         """
@@ -74,19 +82,21 @@ class TestCacheFunction(unittest.TestCase):
         Simultaneously test case where functional form is used.
         """
         # import slowfunctions and config
-        from slowfunctions import slowfunction, slowfunctionsettings
-        slowfunctionsettings['sleeptime'] = 0.25
+        from slowfunctions import slowfunction, slowfunctionsettings, slowfunctionstats
+        slowfunctionsettings['sleeptime'] = 0
 
         # make a pickle file available with some cached data
         fc = FunctionCache(fpath)
         slowfunction = fc.decorator(slowfunction)
         slowfunction(1,2)
-        del fc #deleting fc should trigger fc.save()
+        fc.save()
+        del fc
         del slowfunction
 
         # import slowfunctions and config
         from slowfunctions import slowfunction, slowfunctionsettings
-        slowfunctionsettings['sleeptime'] = 0.25
+        slowfunctionsettings['sleeptime'] = 0
+        slowfunctionstats['calls'] = 0
 
         # decorate the slowfunction using functional syntax
         # I'd have liked to have had this:
@@ -95,15 +105,457 @@ class TestCacheFunction(unittest.TestCase):
         # but that doesn't work on imported functions
         slowfunction = cachefunction(fpath)(slowfunction)
 
-        # run 10x with inputs (1,2)
-        tic = pc()
-        for i in range(10):
-            slowfunction(1,2)
-        toc = pc()
-        self.assertTrue((toc-tic)<0.1)
+        # run 10x with inputs (1,2), every call is served from the reloaded cache
+        list(starmap(slowfunction, repeat((1,2), 10)))
+        self.assertEqual(slowfunctionstats['calls'], 0)
 
         # if you don't delete references to slowfunctioncache, which are hidden inside the functioncache decorator, then another pickle will be generated when tests exit. To prevent this, trigger object deletion now.
         del slowfunction
 
         # clean up
         unlink(fpath)
+        unlink(logpath)
+
+    def test_uncacheable(self):
+        """
+        Test that unhashable arguments call the function without caching,
+        and that a TypeError raised by the function itself is not swallowed.
+        """
+        fc = FunctionCache(fpath)
+        fc.savebeforedelete = False
+
+        calls = []
+        @fc.decorator
+        def total(values):
+            calls.append(values)
+            return sum(values)
+
+        # lists are unhashable, so every call runs the function
+        with self.assertWarns(RuntimeWarning):
+            self.assertEqual(total([1,2]), 3)
+        # later calls with a list skip the cache without trying to hash it
+        self.assertEqual(total([1,2]), 3)
+        self.assertEqual(len(calls), 2)
+
+        # hashable arguments are still cached
+        self.assertEqual(total((1,2)), 3)
+        self.assertEqual(total((1,2)), 3)
+        self.assertEqual(len(calls), 3)
+
+        # sum() raises TypeError for a string, and that error belongs to the caller
+        with self.assertRaises(TypeError):
+            total("ab")
+
+        del total
+        del fc
+
+        # callables without a __qualname__, such as a functools.partial, are also called without caching
+        fc = FunctionCache(fpath)
+        fc.savebeforedelete = False
+        scaled = fc.decorator(partial(lambda factor, values: factor*sum(values), 2))
+        with self.assertWarns(RuntimeWarning):
+            self.assertEqual(scaled([1,2]), 6)
+
+        del scaled
+        del fc
+        unlink(logpath)
+
+    @unittest.skipIf(cachefunctions.msgpack is None, "msgpack is not installed")
+    def test_msgpack(self):
+        """
+        Test that a msgpack cache, including keyword argument keys, survives a save and reload.
+        """
+        mpath = "data/add.msgpack"
+        def add(a, b=0):
+            return a+b
+
+        fc = FunctionCache(mpath, serializer="msgpack")
+        fc.savebeforedelete = False
+        fc.decorator(add)(1, b=2)
+        fc.decorator(add)(3, 4)
+        fc.save()
+        del fc
+
+        reloaded = FunctionCache(mpath, serializer="msgpack")
+        reloaded.savebeforedelete = False
+        def fail(a, b=0):
+            raise AssertionError("result should come from the cache file")
+        self.assertEqual(reloaded.decorator(fail)(1, b=2), 3)
+        self.assertEqual(reloaded.decorator(fail)(3, 4), 7)
+
+        del reloaded
+        unlink(mpath)
+        unlink(mpath + ".log")
+
+    def test_log(self):
+        """
+        Test that entries computed by a run that never saved are recovered from the log.
+        """
+        calls = []
+        def add(a, b):
+            calls.append((a, b))
+            return a+b
+
+        # crash a run, os._exit skips atexit, __del__ and the flushing of open files
+        script = "\n".join([
+            "import os",
+            "from cachefunctions import FunctionCache",
+            f"add = FunctionCache({fpath!r}).decorator(lambda a, b: a+b)",
+            "add(1, 2)",
+            "os._exit(0)"])
+        subprocess.run([sys.executable, "-c", script], check=True)
+        self.assertFalse(exists(fpath))
+
+        # the next run replays the log instead of calling add
+        fc = FunctionCache(fpath)
+        self.assertEqual(fc.decorator(add)(1, 2), 3)
+        self.assertEqual(len(calls), 0)
+
+        # saving folds the log into the cache file, without leaving the temporary file behind
+        fc.save()
+        self.assertFalse(exists(fpath + ".tmp"))
+        with open(logpath, 'rb') as f:
+            self.assertEqual(f.read(), b"")
+        fc.savebeforedelete = False
+        del fc
+
+        # with savebeforedelete off, new results are not logged either
+        fc = FunctionCache(fpath)
+        fc.savebeforedelete = False
+        fc.decorator(add)(5, 6)
+        del fc
+        with open(logpath, 'rb') as f:
+            self.assertEqual(f.read(), b"")
+
+        # a result that cannot be serialized is returned and kept in memory, but not logged
+        fc = FunctionCache(fpath)
+        locks = fc.decorator(lambda n: [threading.Lock() for _ in range(n)])
+        with self.assertWarns(RuntimeWarning):
+            self.assertEqual(len(locks(2)), 2)
+        self.assertIs(locks(2), locks(2))
+        with open(logpath, 'rb') as f:
+            self.assertEqual(f.read(), b"")
+        fc.savebeforedelete = False
+        del locks, fc
+
+        unlink(fpath)
+        unlink(logpath)
+
+    def test_signature(self):
+        """
+        Test that a function with a fixed signature can still be called by keyword,
+        and that positional and keyword calls share cache entries.
+        """
+        fc = FunctionCache(fpath)
+        fc.savebeforedelete = False
+
+        calls = []
+        @fc.decorator
+        def subtract(minuend, subtrahend):
+            """ returns minuend-subtrahend """
+            calls.append((minuend, subtrahend))
+            return minuend-subtrahend
+
+        self.assertEqual(subtract(3, 1), 2)
+        self.assertEqual(subtract(3, subtrahend=1), 2)
+        self.assertEqual(subtract(subtrahend=1, minuend=3), 2)
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(subtract.__name__, "subtract")
+        with self.assertRaises(TypeError):
+            subtract(3)
+
+        del subtract
+        del fc
+        unlink(logpath)
+
+    def test_maxsize(self):
+        """
+        Test that a bounded cache evicts the least recently used result, including on reload.
+        """
+        fc = FunctionCache(fpath, maxsize=2)
+        fc.savebeforedelete = False
+        square = fc.decorator(lambda x: x*x)
+
+        square(1)
+        square(2)
+        square(1)
+        square(3)
+        # 2 was the least recently used result when 3 arrived
+        self.assertEqual(list(fc._cache), [(1,), (3,)])
+        info = square.cache_info()
+        self.assertEqual((info.hits, info.misses, info.maxsize, info.currsize), (1, 3, 2, 2))
+
+        # reloading into a smaller cache keeps the most recently used results
+        fc.save()
+        del square, fc
+        fc = FunctionCache(fpath, maxsize=1)
+        fc.savebeforedelete = False
+        self.assertEqual(list(fc._index), [(3,)])
+        # as with an unbounded cache, a result read from the cache file counts as a miss
+        square = fc.decorator(lambda x: x*x)
+        square(3)
+        square(3)
+        info = square.cache_info()
+        self.assertEqual((info.hits, info.misses, info.currsize), (1, 1, 1))
+
+        # replaying the log into a bounded cache never holds more than maxsize results
+        del square, fc
+        unlink(fpath)
+        fc = FunctionCache(fpath)
+        square = fc.decorator(lambda x: x*x)
+        for x in range(4):
+            square(x)
+        del square, fc
+        fc = FunctionCache(fpath, maxsize=2)
+        fc.savebeforedelete = False
+        self.assertEqual(list(fc._cache), [(2,), (3,)])
+
+        del fc
+        unlink(logpath)
+
+    def test_lazyload(self):
+        """
+        Test that a reloaded cache reads results from the file only when they are requested,
+        and that unread results survive the next save.
+        """
+        import pickle
+        calls = []
+        def add(a, b):
+            calls.append((a, b))
+            return a+b
+
+        fc = FunctionCache(fpath)
+        fc.savebeforedelete = False
+        add2 = fc.decorator(add)
+        add2(1, 2)
+        add2(3, 4)
+        fc.save()
+        del add2, fc
+
+        # nothing is read until it is requested
+        fc = FunctionCache(fpath)
+        fc.savebeforedelete = False
+        self.assertEqual(len(fc._cache), 0)
+        self.assertEqual(fc.decorator(add)(1, 2), 3)
+        self.assertEqual(list(fc._cache), [(1, 2)])
+        self.assertEqual(list(fc._index), [(3, 4)])
+
+        # the unread result is copied into the new file
+        fc.save()
+        del fc
+        fc = FunctionCache(fpath)
+        fc.savebeforedelete = False
+        self.assertEqual(fc.decorator(add)(3, 4), 7)
+        self.assertEqual(len(calls), 2)
+        del fc
+
+        # cache files written by earlier versions hold a single pickled dictionary keyed by (args, kwargs)
+        with open(fpath, 'wb') as f:
+            pickle.dump({((5, 6), ()): 11}, f)
+        fc = FunctionCache(fpath)
+        fc.savebeforedelete = False
+        self.assertEqual(fc.decorator(add)(5, 6), 11)
+        self.assertEqual(len(calls), 2)
+        del fc
+
+        unlink(fpath)
+        unlink(logpath)
+
+    def test_saveall(self):
+        """
+        Test that the exit hook only saves caches with a large enough log, and that a cache failing to save does not stop the others.
+        """
+        paths = ("data/unchanged.pkl", "data/unsaveable.pkl", "data/saveable.pkl")
+        unchanged, unsaveable, saveable = (FunctionCache(path) for path in paths)
+        unchanged.decorator(lambda x: x)(1)
+        unsaveable.compactsize = saveable.compactsize = 0
+        with self.assertWarns(RuntimeWarning):
+            unsaveable.decorator(lambda x: threading.Lock())(1)
+        saveable.decorator(lambda x: x)(1)
+
+        with self.assertWarns(RuntimeWarning):
+            cachefunctions._saveall()
+        self.assertEqual([exists(path) for path in paths], [False, False, True])
+
+        for fc in (unchanged, unsaveable, saveable):
+            fc.savebeforedelete = False
+        del unchanged, unsaveable, saveable, fc
+        unlink(paths[2])
+        for path in paths:
+            unlink(path + ".log")
+
+    def test_badarguments(self):
+        """
+        Test that a FunctionCache that fails to initialize raises, and is deleted without further errors.
+        """
+        unraisable = []
+        hook, sys.unraisablehook = sys.unraisablehook, unraisable.append
+        try:
+            for args, kwargs, error in (((fpath,), {"maxsize": 0}, ValueError), ((fpath,), {"serializer": "json"}, ValueError), (("data",), {}, Exception)):
+                with self.subTest(args=args, kwargs=kwargs):
+                    with self.assertRaises(error):
+                        FunctionCache(*args, **kwargs)
+        finally:
+            sys.unraisablehook = hook
+        self.assertEqual(unraisable, [])
+
+    def test_instances(self):
+        """
+        Test that every FunctionCache of a file is the same object, so only one of them saves at exit.
+        """
+        fc = FunctionCache(fpath)
+        fc.savebeforedelete = False
+        self.assertIs(FunctionCache("data/../" + fpath), fc)
+
+        # the existing cache is returned as it is, not reloaded
+        fc.decorator(lambda a, b: a+b)(1, 2)
+        self.assertEqual(len(FunctionCache(fpath)._cache), 1)
+
+        # asking for different settings is an error rather than a silent mismatch
+        with self.assertRaises(ValueError):
+            FunctionCache(fpath, maxsize=10)
+
+        # the cache keeps its resolved path, so it saves next to its log after a change of working directory
+        cwd = os.getcwd()
+        try:
+            os.chdir("data")
+            self.assertIs(FunctionCache(os.path.basename(fpath)), fc)
+            fc.save()
+        finally:
+            os.chdir(cwd)
+        self.assertTrue(exists(fpath))
+
+        del fc
+        unlink(fpath)
+        unlink(logpath)
+
+    def test_twofunctions(self):
+        """
+        Test that two different functions cannot share one cache file, since their keys would collide.
+        """
+        def double(x):
+            return 2*x
+        def square(x):
+            return x*x
+
+        double = cachefunction(fpath)(double)
+        FunctionCache(fpath).savebeforedelete = False
+        self.assertEqual(double(3), 6)
+        with self.assertRaises(ValueError):
+            cachefunction(fpath)(square)
+
+        # decorating the same function again is fine and shares its results
+        self.assertEqual(FunctionCache(fpath).decorator(double.__wrapped__)(3), 6)
+        del double
+
+        # lambdas share the qualified name <lambda>, closures from one factory share theirs, and both are still told apart
+        def make(n):
+            def add(x):
+                return x+n
+            return add
+        for first, second in ((lambda x: x*x, lambda x: 2*x), (make(1), make(100))):
+            with self.subTest(first=first, second=second):
+                fc = FunctionCache(fpath)
+                fc.savebeforedelete = False
+                fc.decorator(first)(3)
+                with self.assertRaises(ValueError):
+                    fc.decorator(second)
+                del fc
+
+        unlink(logpath)
+
+    def test_baselinefile(self):
+        """
+        Test that a cache file written by the original (args, kwargs) key format still hits, and is rewritten in the current format.
+        """
+        import pickle
+        calls = []
+        def add(a, b=0):
+            calls.append((a, b))
+            return a+b
+
+        with open(fpath, 'wb') as f:
+            pickle.dump({((1,), (('b', 2),)): 3, ((5, 6), ()): 11}, f)
+        fc = FunctionCache(fpath)
+        fc.savebeforedelete = False
+        add2 = fc.decorator(add)
+        self.assertEqual(add2(1, b=2), 3)
+        self.assertEqual(add2(5, 6), 11)
+        self.assertEqual(len(calls), 0)
+
+        # no entry is kept under its old key
+        fc.save()
+        del add2, fc
+        fc = FunctionCache(fpath)
+        fc.savebeforedelete = False
+        self.assertEqual(set(fc._index), {(5, 6), ((1,), cachefunctions._KWMARK, (('b', 2),))})
+        del fc
+
+        unlink(fpath)
+        unlink(logpath)
+
+    def test_manyarguments(self):
+        """
+        Test that keys of calls with many arguments, which are wrapped in a _CacheKey, survive a save and reload.
+        """
+        calls = []
+        def total(*args, **kwargs):
+            calls.append(args)
+            return sum(args) + sum(kwargs.values())
+
+        for serializer, path in (("pickle", "data/many.pkl"), ("msgpack", "data/many.msgpack")):
+            with self.subTest(serializer=serializer):
+                if serializer == "msgpack" and cachefunctions.msgpack is None:
+                    self.skipTest("msgpack is not installed")
+                del calls[:]
+                fc = FunctionCache(path, serializer=serializer)
+                fc.savebeforedelete = False
+                total2 = fc.decorator(total)
+                self.assertEqual(total2(*range(10)), 45)
+                self.assertEqual(total2(*range(8), x=1), 29)
+                self.assertTrue(all(type(key) is cachefunctions._CacheKey for key in fc._cache))
+                fc.save()
+                del total2, fc
+
+                fc = FunctionCache(path, serializer=serializer)
+                fc.savebeforedelete = False
+                self.assertTrue(all(type(key) is cachefunctions._CacheKey for key in fc._index))
+                total2 = fc.decorator(total)
+                self.assertEqual(total2(*range(10)), 45)
+                self.assertEqual(total2(*range(8), x=1), 29)
+                self.assertEqual(len(calls), 2)
+                del total2, fc
+
+                unlink(path)
+                unlink(path + ".log")
+
+    @unittest.skipIf(cachefunctions._fastmakekey is None, "cachefunctions._fastkey is not compiled")
+    def test_fastmakekey(self):
+        """
+        Test that the compiled cachefunctions._fastkey.makekey builds the same keys as the python code.
+        """
+        def total(*args, **kwargs):
+            return sum(args) + sum(kwargs.values())
+        calls = (((1, 2), {}), ((1,), {"b": 2, "a": 3}), (tuple(range(9)), {}), (tuple(range(8)), {"x": 1}), ((), {"a": 1}))
+
+        keys = {}
+        fastmakekey = cachefunctions._fastmakekey
+        for compiled, path in ((True, "data/fastkey.pkl"), (False, "data/slowkey.pkl")):
+            # the decorator binds _fastmakekey when it decorates, so patching it before then selects the python code
+            cachefunctions._fastmakekey = fastmakekey if compiled else None
+            try:
+                fc = FunctionCache(path)
+                fc.savebeforedelete = False
+                total2 = fc.decorator(total)
+            finally:
+                cachefunctions._fastmakekey = fastmakekey
+            for args, kwargs in calls:
+                self.assertEqual(total2(*args, **kwargs), total(*args, **kwargs))
+            keys[compiled] = list(fc._cache)
+            del total2, fc
+            if exists(path + ".log"):
+                unlink(path + ".log")
+
+        self.assertEqual(keys[True], keys[False])
+        self.assertEqual(len(keys[True]), len(calls))
+        self.assertEqual(fastmakekey((1,), {"b": 2, "a": 3}, cachefunctions._KWMARK), ((1,), cachefunctions._KWMARK, (("a", 3), ("b", 2))))
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import unittest
+from itertools import starmap
 from time import perf_counter as pc
 from slowfunctions import slowfunction, slowfunctionsettings
 
@@ -27,12 +28,11 @@ class Testslowfunction(unittest.TestCase):
                 (3,4),
                 (1,2)]
 
-        for args in argss:
-            # the first argument is a reconstruction of the logic inside the slowfunction function itself
-            self.assertEqual(
-                hash((tuple(args), tuple([]))),
-                slowfunction(*args)
-                )
+        # the first argument is a reconstruction of the logic inside the slowfunction function itself
+        self.assertEqual(
+            [hash((tuple(args), frozenset())) for args in argss],
+            list(starmap(slowfunction, argss))
+            )
 
         # test ability to pass keyword arguments and get consistent results
         hash1 = slowfunction(name="David", age=21)
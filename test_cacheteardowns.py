@@ -13,9 +13,10 @@ from os.path import exists
 fpath = "data/teardown.pkl"
 
 if __name__ == "__main__":
-    # start without a pickle file
-    if exists(fpath):
-        unlink(fpath)
+    # start without a pickle file or log
+    for path in (fpath, fpath + ".log"):
+        if exists(path):
+            unlink(path)
     # create a function to cache
     @cachefunction(fpath)
     def add2(a,b):